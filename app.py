@@ -1,184 +1,455 @@
 import os
 import json
+import collections
+import contextlib
+import hashlib
+import html
 import gradio as gr
 import subprocess
+import sys
 import pandas as pd
 from pathlib import Path
 import shutil
 import time
 import re
+import threading
+import urllib.parse
+import uuid
 import zipfile
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 
 # 创建工作目录
 WORKSPACE_DIR = "olmocr_workspace"
 os.makedirs(WORKSPACE_DIR, exist_ok=True)
 
-def modify_html_for_better_display(html_content):
-    """修改HTML以便在Gradio中更好地显示"""
-    if not html_content:
-        return html_content
-    
+# HTML预览单独存放，只有该目录通过Gradio的文件路由对外提供
+PREVIEW_DIR = "olmocr_previews"
+os.makedirs(PREVIEW_DIR, exist_ok=True)
+
+# Gradio 5起allowed_paths中的HTML文件以inline方式返回，预览可以通过iframe加载；
+# Gradio 4对text/html一律以附件方式返回（allowed_paths和set_static_paths均如此），只能直接返回HTML字符串
+_PREVIEW_IN_IFRAME = int(gr.__version__.split(".")[0]) >= 5
+
+# 正在使用中的任务目录和预览文件（路径 -> 使用计数），后台清理线程会跳过这些路径
+_active_paths = collections.Counter()
+_active_paths_lock = threading.Lock()
+
+# 清理线程删除前先将路径改名为此前缀
+_REAPED_PREFIX = ".reaped_"
+
+# 界面中显示的日志最大字节数
+LOG_TAIL_BYTES = 64_000
+
+# 写入ZIP时每次写入的字节数
+ZIP_CHUNK_BYTES = 256 * 1024
+
+# 缩放控制
+_ZOOM_CONTROLS = """
+    <div style="position: fixed; bottom: 20px; right: 20px; background: #fff; padding: 10px; border-radius: 5px; box-shadow: 0 0 10px rgba(0,0,0,0.2); z-index: 1000;">
+        <button onclick="document.body.style.zoom = parseFloat(document.body.style.zoom || 1) + 0.1;" style="margin-right: 5px;">放大</button>
+        <button onclick="document.body.style.zoom = parseFloat(document.body.style.zoom || 1) - 0.1;">缩小</button>
+    </div>
+    """
+
+# HTML预览的固定字符串替换，合并为一次扫描
+_HTML_SUBS = {
     # 增加容器宽度
-    html_content = html_content.replace('<div class="container">', 
-                                       '<div class="container" style="max-width: 100%; width: 100%;">')
-    
+    '<div class="container">': '<div class="container" style="max-width: 100%; width: 100%;">',
     # 增加文本大小
-    html_content = html_content.replace('<style>', 
-                                       '<style>\nbody {font-size: 16px;}\n.text-content {font-size: 16px; line-height: 1.5;}\n')
-    
+    '<style>': '<style>\nbody {font-size: 16px;}\n.text-content {font-size: 16px; line-height: 1.5;}\n',
     # 调整图像和文本部分的大小比例
-    html_content = html_content.replace('<div class="row">', 
-                                       '<div class="row" style="display: flex; flex-wrap: wrap;">')
-    html_content = html_content.replace('<div class="col-md-6">', 
-                                       '<div class="col-md-6" style="flex: 0 0 50%; max-width: 50%; padding: 15px;">')
-    
+    '<div class="row">': '<div class="row" style="display: flex; flex-wrap: wrap;">',
+    '<div class="col-md-6">': '<div class="col-md-6" style="flex: 0 0 50%; max-width: 50%; padding: 15px;">',
     # 增加页面之间的间距
-    html_content = html_content.replace('<div class="page">', 
-                                       '<div class="page" style="margin-bottom: 30px; border-bottom: 1px solid #ccc; padding-bottom: 20px;">')
+    '<div class="page">': '<div class="page" style="margin-bottom: 30px; border-bottom: 1px solid #ccc; padding-bottom: 20px;">',
+    # 添加缩放控制
+    '</body>': f'{_ZOOM_CONTROLS}</body>',
+}
+_HTML_SUB_RE = re.compile("|".join(re.escape(k) for k in _HTML_SUBS))
+_IMG_STYLE_RE = re.compile(r'<img([^>]*)style="([^"]*)"')
+_UNSAFE_FILENAME_RE = re.compile(r'[^\w.-]+')
+
+def modify_html_for_better_display(html_content):
+    """修改HTML以便在Gradio中更好地显示"""
+    # 内容为空或不是预期的预览页面时无需处理
+    if not html_content or ('<div class="container">' not in html_content and '<style>' not in html_content):
+        return html_content
     
-    # 增加图像大小
-    html_content = re.sub(r'<img([^>]*)style="([^"]*)"', 
-                         r'<img\1style="max-width: 100%; height: auto; \2"', 
-                         html_content)
+    html_content = _HTML_SUB_RE.sub(lambda m: _HTML_SUBS[m.group(0)], html_content)
     
-    # 添加缩放控制
-    zoom_controls = """
-    <div style="position: fixed; bottom: 20px; right: 20px; background: #fff; padding: 10px; border-radius: 5px; box-shadow: 0 0 10px rgba(0,0,0,0.2); z-index: 1000;">
-        <button onclick="document.body.style.zoom = parseFloat(document.body.style.zoom || 1) + 0.1;" style="margin-right: 5px;">放大</button>
-        <button onclick="document.body.style.zoom = parseFloat(document.body.style.zoom || 1) - 0.1;">缩小</button>
-    </div>
-    """
-    html_content = html_content.replace('</body>', f'{zoom_controls}</body>')
+    # 增加图像大小
+    html_content = _IMG_STYLE_RE.sub(r'<img\1style="max-width: 100%; height: auto; \2"', html_content)
     
     return html_content
 
+def _safe_filename(path):
+    """从路径中提取文件名（不含扩展名），替换不安全字符并限制长度"""
+    name = os.path.splitext(os.path.basename(path))[0]
+    return _UNSAFE_FILENAME_RE.sub("_", name)[:120] or "document"
+
+def _link_or_copy(src, dst, symlink=True):
+    """优先使用硬链接，其次符号链接，最后才复制文件（pipeline只读取输入PDF）
+    
+    src可能在之后被删除（如Gradio的上传临时文件）而dst需要长期保留时，应传入symlink=False。
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        if symlink:
+            try:
+                os.symlink(os.path.abspath(src), dst)
+                return
+            except OSError:
+                pass
+        shutil.copy(src, dst)
+
+def _hash_file(path):
+    """流式计算文件内容的哈希值（每次读取1 MiB）"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _read_log_tail(log_path):
+    """读取日志文件末尾内容"""
+    if not os.path.exists(log_path):
+        return ""
+    with open(log_path, "rb") as lf:
+        lf.seek(max(0, os.path.getsize(log_path) - LOG_TAIL_BYTES))
+        return lf.read().decode("utf-8", "replace")
+
+def _run_logged(cmd, log_path):
+    """执行命令并将输出写入日志文件，返回退出码和日志末尾内容"""
+    with open(log_path, "w") as lf:
+        proc = subprocess.Popen(cmd, stdout=lf, stderr=subprocess.STDOUT)
+        returncode = proc.wait()
+    return returncode, _read_log_tail(log_path)
+
+def _write_bytes(path, data):
+    """通过原始文件描述符一次性写入已编码的数据"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if data and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, len(data))
+            except OSError:
+                pass
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def _find_files(dirpath, prefix, suffix):
+    """列出目录中符合前缀和后缀的文件，目录不存在时返回空列表"""
+    try:
+        with os.scandir(dirpath) as it:
+            return [e.path for e in it if e.name.startswith(prefix) and e.name.endswith(suffix)]
+    except FileNotFoundError:
+        return []
+
+def _zip_write_bytes(zipf, name, data, date_time):
+    """以流式方式将已编码的数据分块写入ZIP，避免writestr的整块复制"""
+    zinfo = zipfile.ZipInfo(name, date_time=date_time)
+    zinfo.compress_type = zipf.compression
+    # 传入ZipInfo时ZipFile.open不会沿用ZipFile的压缩级别，需要手动设置，否则会退回默认级别；
+    # Python 3.13起该属性公开为compress_level
+    if sys.version_info >= (3, 13):
+        zinfo.compress_level = zipf.compresslevel
+    else:
+        zinfo._compresslevel = zipf.compresslevel
+    zinfo.external_attr = 0o644 << 16
+    # 预先给出大小，由zipfile判断是否需要ZIP64
+    zinfo.file_size = len(data)
+    with zipf.open(zinfo, "w") as w:
+        view = memoryview(data)
+        for i in range(0, len(view), ZIP_CHUNK_BYTES):
+            w.write(view[i:i + ZIP_CHUNK_BYTES])
+
+def _iter_jsonl(path):
+    """逐行读取JSONL文件，跳过空行，按需解析每条记录"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+@contextlib.contextmanager
+def _mark_active(path):
+    """标记任务目录或预览文件正在使用，结束时更新修改时间，使清理线程从此刻起计算过期时间"""
+    path = os.path.abspath(path)
+    with _active_paths_lock:
+        _active_paths[path] += 1
+    try:
+        yield
+    finally:
+        with _active_paths_lock:
+            _active_paths[path] -= 1
+            if not _active_paths[path]:
+                del _active_paths[path]
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+
+def _reap_workspace(ttl=3600, interval=300):
+    """后台定期清理超过ttl秒未修改且未在使用中的任务目录和HTML预览"""
+    while True:
+        # 任何异常都不能结束清理线程，否则之后将不再清理
+        try:
+            now = time.time()
+            for root in (WORKSPACE_DIR, PREVIEW_DIR):
+                try:
+                    entries = list(Path(root).iterdir())
+                except OSError:
+                    continue
+                for p in entries:
+                    try:
+                        if p.name.startswith(_REAPED_PREFIX):
+                            # 上次未能删除干净的待删除项
+                            tombstone = p
+                        else:
+                            # 持锁检查并改名，避免任务在检查后开始使用该路径；耗时的删除在锁外进行
+                            with _active_paths_lock:
+                                if os.path.abspath(p) in _active_paths or now - p.stat().st_mtime <= ttl:
+                                    continue
+                                tombstone = p.with_name(f"{_REAPED_PREFIX}{uuid.uuid4().hex}_{p.name}")
+                                p.rename(tombstone)
+                        
+                        if tombstone.is_dir():
+                            shutil.rmtree(tombstone, ignore_errors=True)
+                        else:
+                            tombstone.unlink()
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        print(f"清理 {p} 失败: {e}")
+        except Exception as e:
+            print(f"清理工作目录时发生错误: {e}")
+        time.sleep(interval)
+
 def process_pdf(pdf_file, progress=gr.Progress()):
     """处理PDF文件并返回结果"""
     if pdf_file is None:
         return "请上传PDF文件", "", None, None, None
     
-    # 创建一个唯一的工作目录
-    timestamp = int(time.time())
-    work_dir = os.path.join(WORKSPACE_DIR, f"job_{timestamp}")
-    os.makedirs(work_dir, exist_ok=True)
-    
-    # 获取原始PDF文件名（不包含路径和扩展名）
-    original_filename = os.path.splitext(os.path.basename(pdf_file))[0]
-    
-    # 复制PDF文件
+    # 以文件内容哈希作为工作目录，相同的PDF直接复用之前的结果
+    work_dir = os.path.join(WORKSPACE_DIR, f"job_{_hash_file(pdf_file)}")
+    results_dir = os.path.join(work_dir, "results")
+    log_path = os.path.join(work_dir, "pipeline.log")
     pdf_path = os.path.join(work_dir, "input.pdf")
-    shutil.copy(pdf_file, pdf_path)
-    
-    # 构建命令并执行
-    cmd = ["python", "-m", "olmocr.pipeline", work_dir, "--pdfs", pdf_path]
-    
-    try:
-        progress(0.2, desc="正在处理PDF...")
-        # 执行命令，等待完成
-        process = subprocess.run(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            check=True
-        )
+    # pipeline的--markdown选项按输入路径的目录结构写出文本文件
+    markdown_file = os.path.join(work_dir, "markdown", os.path.dirname(pdf_path), "input.md")
+    # 修改后的预览写入单独的预览目录，Gradio 5下通过iframe直接提供，避免传输整个HTML字符串
+    preview_path = os.path.join(PREVIEW_DIR, f"{os.path.basename(work_dir)}.html")
+    # 请求期间同时保护任务目录和预览文件不被清理，结束时会更新两者的修改时间
+    with _mark_active(work_dir), _mark_active(preview_path):
+        os.makedirs(work_dir, exist_ok=True)
         
-        progress(0.6, desc="正在生成预览...")
-        # 命令输出
-        log_text = process.stdout
+        # 获取规范化的原始PDF文件名（不包含路径和扩展名）
+        original_filename = _safe_filename(pdf_file)
         
-        # 检查结果目录
-        results_dir = os.path.join(work_dir, "results")
-        if not os.path.exists(results_dir):
-            return f"处理完成，但未生成结果目录\n\n日志输出:\n{log_text}", "", None, None, None
-        
-        # 查找输出文件
-        output_files = list(Path(results_dir).glob("output_*.jsonl"))
-        if not output_files:
-            return f"处理完成，但未找到输出文件\n\n日志输出:\n{log_text}", "", None, None, None
-        
-        progress(0.8, desc="正在生成下载文件...")
-        # 读取JSONL文件
-        output_file = output_files[0]
-        with open(output_file, "r") as f:
-            content = f.read().strip()
-            if not content:
+        try:
+            if _find_files(results_dir, "output_", ".jsonl"):
+                progress(0.2, desc="使用缓存结果...")
+                log_text = _read_log_tail(log_path)
+                # 重新生成预览时dolmaviewer需要读取输入PDF，旧缓存中的链接可能已失效
+                if not os.path.exists(pdf_path):
+                    if os.path.lexists(pdf_path):
+                        os.remove(pdf_path)
+                    _link_or_copy(pdf_file, pdf_path, symlink=False)
+            else:
+                # 链接（或复制）PDF文件，先移除上次失败运行留下的链接
+                # 任务目录会作为缓存保留，不能使用指向上传临时文件的符号链接
+                if os.path.lexists(pdf_path):
+                    os.remove(pdf_path)
+                _link_or_copy(pdf_file, pdf_path, symlink=False)
+                
+                # 构建命令并执行
+                cmd = ["python", "-m", "olmocr.pipeline", work_dir, "--markdown", "--pdfs", pdf_path]
+                
+                progress(0.2, desc="正在处理PDF...")
+                # 执行命令，输出写入日志文件，等待完成
+                returncode, log_text = _run_logged(cmd, log_path)
+                if returncode != 0:
+                    return f"命令执行失败:\n{log_text}", "", None, None, None
+            
+            progress(0.6, desc="正在生成预览...")
+            
+            # 检查结果目录
+            if not os.path.exists(results_dir):
+                return f"处理完成，但未生成结果目录\n\n日志输出:\n{log_text}", "", None, None, None
+            
+            # 查找输出文件
+            output_files = _find_files(results_dir, "output_", ".jsonl")
+            if not output_files:
+                return f"处理完成，但未找到输出文件\n\n日志输出:\n{log_text}", "", None, None, None
+            
+            progress(0.8, desc="正在生成下载文件...")
+            # 读取JSONL文件的第一条记录
+            output_file = output_files[0]
+            result = next(_iter_jsonl(output_file), None)
+            if result is None:
                 return f"输出文件为空\n\n日志输出:\n{log_text}", "", None, None, None
             
-            # 解析JSON
-            result = json.loads(content)
             extracted_text = result.get("text", "未找到文本内容")
             
-            # 生成HTML预览
+            # 在后台生成HTML预览，输出到本任务的预览目录，避免并发任务互相覆盖
+            preview_dir = os.path.join(work_dir, "preview")
+            viewer_proc = None
+            if not _find_files(preview_dir, "", ".html"):
+                try:
+                    preview_cmd = ["python", "-m", "olmocr.viewer.dolmaviewer", output_file, "--output_dir", preview_dir]
+                    viewer_proc = subprocess.Popen(preview_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                except Exception as e:
+                    log_text += f"\n生成HTML预览失败: {str(e)}"
+            
             try:
-                preview_cmd = ["python", "-m", "olmocr.viewer.dolmaviewer", str(output_file)]
-                subprocess.run(preview_cmd, check=True)
-            except Exception as e:
-                log_text += f"\n生成HTML预览失败: {str(e)}"
+                # 预览生成期间创建元数据表格
+                metadata = result.get("metadata", {})
+                df = pd.DataFrame({"属性": list(metadata.keys()), "值": list(metadata.values())})
+                
+                # 创建下载文件，使用原始文件名
+                # 优先链接pipeline写出的文本文件，缺失时才重新写入提取的文本
+                download_file = os.path.join(work_dir, f"{original_filename}_extracted_text.txt")
+                if not os.path.exists(download_file):
+                    if os.path.exists(markdown_file):
+                        _link_or_copy(markdown_file, download_file)
+                    else:
+                        _write_bytes(download_file, extracted_text.encode("utf-8"))
+            except BaseException:
+                # 出错时结束预览进程并回收，避免遗留子进程和未读取的管道
+                if viewer_proc is not None:
+                    viewer_proc.kill()
+                    viewer_proc.communicate()
+                raise
             
-            # 查找HTML文件
-            html_files = list(Path("dolma_previews").glob("*.html"))
-            html_content = ""
-            if html_files:
+            # 等待HTML预览生成完成
+            if viewer_proc is not None:
                 try:
-                    with open(html_files[0], "r", encoding="utf-8") as hf:
-                        html_content = hf.read()
+                    _, viewer_stderr = viewer_proc.communicate(timeout=120)
+                    if viewer_proc.returncode != 0:
+                        log_text += f"\n生成HTML预览失败: {viewer_stderr.decode('utf-8', 'replace')}"
+                except subprocess.TimeoutExpired:
+                    viewer_proc.kill()
+                    viewer_proc.communicate()
+                    log_text += "\n生成HTML预览超时"
+            
+            if viewer_proc is not None or not os.path.exists(preview_path):
+                # 查找HTML文件，取最新生成的一个
+                html_files = sorted(_find_files(preview_dir, "", ".html"), key=os.path.getmtime, reverse=True)
+                if html_files:
+                    try:
+                        # 以二进制方式一次性读取并解码
+                        with open(html_files[0], "rb", buffering=1 << 20) as hf:
+                            html_content = hf.read().decode("utf-8", "replace")
                         # 修改HTML以更好地显示
                         html_content = modify_html_for_better_display(html_content)
-                except Exception as e:
-                    log_text += f"\n读取HTML预览失败: {str(e)}"
-            
-            # 创建元数据表格
-            metadata = result.get("metadata", {})
-            meta_rows = []
-            for key, value in metadata.items():
-                meta_rows.append([key, value])
+                        with open(preview_path, "w", encoding="utf-8") as pf:
+                            pf.write(html_content)
+                    except Exception as e:
+                        log_text += f"\n读取HTML预览失败: {str(e)}"
             
-            df = pd.DataFrame(meta_rows, columns=["属性", "值"])
-            
-            # 创建下载文件，使用原始文件名
-            download_file = os.path.join(work_dir, f"{original_filename}_extracted_text.txt")
-            with open(download_file, "w", encoding="utf-8") as f:
-                f.write(extracted_text)
+            html_content = ""
+            if os.path.exists(preview_path):
+                if _PREVIEW_IN_IFRAME:
+                    # 使用相对路径，避免暴露服务器目录结构
+                    src = html.escape("/gradio_api/file=" + urllib.parse.quote(Path(preview_path).as_posix()))
+                    html_content = f'<iframe src="{src}" style="width:100%;height:800px;border:0"></iframe>'
+                else:
+                    with open(preview_path, "rb", buffering=1 << 20) as pf:
+                        html_content = pf.read().decode("utf-8", "replace")
             
             progress(1.0, desc="处理完成！")
             return log_text, extracted_text, html_content, df, download_file
-        
-    except subprocess.CalledProcessError as e:
-        return f"命令执行失败: {e.stderr}", "", None, None, None
-    except Exception as e:
-        return f"处理过程中发生错误: {str(e)}", "", None, None, None
+            
+        except Exception as e:
+            return f"处理过程中发生错误: {str(e)}", "", None, None, None
 
 def process_multiple_pdfs(pdf_files, progress=gr.Progress()):
-    """处理多个PDF文件"""
+    """处理多个PDF文件（所有文件只调用一次pipeline，避免重复加载模型）"""
     if not pdf_files:
         return "请上传PDF文件", None
     
     # 创建批量处理工作目录
-    timestamp = int(time.time())
-    batch_dir = os.path.join(WORKSPACE_DIR, f"batch_{timestamp}")
-    os.makedirs(batch_dir, exist_ok=True)
-    
-    # 创建ZIP文件
-    zip_path = os.path.join(batch_dir, "extracted_texts.zip")
-    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+    batch_dir = os.path.join(WORKSPACE_DIR, f"batch_{uuid.uuid4().hex}")
+    with _mark_active(batch_dir):
+        inputs_dir = os.path.join(batch_dir, "inputs")
+        os.makedirs(inputs_dir, exist_ok=True)
+        
         total_files = len(pdf_files)
-        for i, pdf_file in enumerate(pdf_files, 1):
-            progress(i/total_files, desc=f"正在处理第 {i}/{total_files} 个文件...")
-            
-            # 处理单个PDF
-            log_text, extracted_text, _, _, _ = process_pdf(pdf_file)
+        with ThreadPoolExecutor(max_workers=min(4, total_files)) as executor:
+            # 计算文件内容哈希，内容相同的PDF只处理一次
+            progress(0.05, desc="正在检查重复文件...")
+            digest_to_names = {}
+            digest_to_entries = {}
+            unique_files = {}
+            used_entries = set()
+            for pdf_file, digest in zip(pdf_files, executor.map(_hash_file, pdf_files)):
+                unique_files.setdefault(digest, pdf_file)
+                
+                # 同一内容以相同文件名重复上传时只写入一次
+                original_filename = _safe_filename(pdf_file)
+                names = digest_to_names.setdefault(digest, [])
+                if original_filename in names:
+                    continue
+                names.append(original_filename)
+                
+                # 不同文件规范化后可能重名，添加序号避免ZIP中出现重复条目
+                text_filename = f"{original_filename}_extracted_text.txt"
+                suffix = 2
+                while text_filename in used_entries:
+                    text_filename = f"{original_filename}_{suffix}_extracted_text.txt"
+                    suffix += 1
+                used_entries.add(text_filename)
+                digest_to_entries.setdefault(digest, []).append(text_filename)
             
-            # 获取原始文件名
-            original_filename = os.path.splitext(os.path.basename(pdf_file))[0]
+            # 将每个不重复的PDF链接到同一个输入目录，并记录输入路径到哈希的映射
+            input_digests = {}
+            futures = []
+            for digest, pdf_file in unique_files.items():
+                input_path = os.path.join(inputs_dir, f"{digest}.pdf")
+                futures.append(executor.submit(_link_or_copy, pdf_file, input_path))
+                input_digests[os.path.normpath(input_path)] = digest
             
-            # 将提取的文本添加到ZIP文件
-            text_filename = f"{original_filename}_extracted_text.txt"
-            zipf.writestr(text_filename, extracted_text)
-    
-    return "所有文件处理完成！", zip_path
+            for done_count, future in enumerate(as_completed(futures), 1):
+                future.result()
+                progress(0.05 + 0.05 * done_count / len(futures), desc=f"正在准备第 {done_count}/{len(futures)} 个文件...")
+        
+        # 所有文件只执行一次pipeline
+        cmd = ["python", "-m", "olmocr.pipeline", batch_dir, "--pdfs", *input_digests]
+        
+        progress(0.2, desc=f"正在处理 {len(input_digests)} 个文件...")
+        returncode, log_text = _run_logged(cmd, os.path.join(batch_dir, "pipeline.log"))
+        if returncode != 0:
+            return f"命令执行失败:\n{log_text}", None
+        
+        progress(0.8, desc="正在打包结果...")
+        # 创建ZIP文件
+        zip_path = os.path.join(batch_dir, "extracted_texts.zip")
+        done = set()
+        # 纯文本压缩以CPU为瓶颈，使用最低压缩级别；底层文件使用1 MiB写缓冲
+        with open(zip_path, "wb", buffering=1 << 20) as fh, \
+                zipfile.ZipFile(fh, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zipf:
+            date_time = time.localtime()[:6]
+            for output_file in _find_files(os.path.join(batch_dir, "results"), "output_", ".jsonl"):
+                for result in _iter_jsonl(output_file):
+                    source = os.path.normpath(result.get("metadata", {}).get("Source-File", ""))
+                    digest = input_digests.get(source)
+                    if digest is None:
+                        continue
+                    
+                    # 将提取的文本编码一次，按每个原始文件名添加到ZIP文件
+                    data = result.get("text", "").encode("utf-8")
+                    for text_filename in digest_to_entries[digest]:
+                        _zip_write_bytes(zipf, text_filename, data, date_time)
+                    done.add(digest)
+        
+        missing = [name for digest, names in digest_to_names.items() if digest not in done for name in names]
+        if missing:
+            return "处理完成，但以下文件未生成结果:\n" + "\n".join(missing), zip_path
+        return "所有文件处理完成！", zip_path
 
 # 创建Gradio界面
 with gr.Blocks(title="olmOCR PDF提取工具") as app:
@@ -260,20 +531,29 @@ with gr.Blocks(title="olmOCR PDF提取工具") as app:
         fn=process_pdf,
         inputs=pdf_input,
         outputs=[log_output, text_output, html_output, meta_output, download_btn],
-        api_name="process"
+        api_name="process",
+        # 与批量处理共用并发队列：每次都会启动独占GPU和固定端口的pipeline
+        concurrency_limit=1,
+        concurrency_id="olmocr_pipeline"
     )
     
     batch_process_btn.click(
         fn=process_multiple_pdfs,
         inputs=pdf_inputs,
         outputs=[log_output, batch_download],
-        api_name="batch_process"
+        api_name="batch_process",
+        concurrency_limit=1,
+        concurrency_id="olmocr_pipeline"
     )
 
 # 启动应用
 if __name__ == "__main__":
-    app.launch(
+    # 启动后台清理线程
+    threading.Thread(target=_reap_workspace, daemon=True).start()
+    # 限制排队请求数量，处理函数的并发由事件上的concurrency_id控制
+    app.queue(max_size=32).launch(
         server_name="0.0.0.0",  # 允许局域网访问
         server_port=7860,       # 指定端口
-        share=False            # 禁用分享功能
+        share=False,           # 禁用分享功能
+        allowed_paths=[PREVIEW_DIR]  # 只允许通过文件路由访问HTML预览
     )